@@ -13,19 +13,18 @@
 # limitations under the License.
 # ==============================================================================
 
+import os
 import random
 import numpy as np
 import tensorflow as tf  # TF2
 import matplotlib.pyplot as plt
 from skimage.io import imsave
-import cv2
-import skimage
 
 assert tf.__version__.startswith('2'), 'use tensorflow 2.x'
 
 IMG_WIDTH = 384
 IMG_HEIGHT = 384
-PARALLEL_CALLS = 4
+PARALLEL_CALLS = tf.data.experimental.AUTOTUNE
 
 BUFFER_SIZE = 400
 BATCH_SIZE = 4
@@ -33,6 +32,9 @@ EPOCHS = 50
 
 SMOOTH = 1e-5
 
+DICE_CLASS_WEIGHTS = tf.constant([0.5, 0.5, 1.], dtype=tf.float32)
+CCE = tf.keras.losses.CategoricalCrossentropy(label_smoothing=0.3, reduction=tf.keras.losses.Reduction.NONE)
+
 BACKBONE_LAYER_NAMES = {
     'vgg19': [
         'block2_conv2',
@@ -75,19 +77,32 @@ class Config():
 
 
 def decode_img(img):
-    """ Decodes an tensor of type string to an float32 tensor. Has to be applied with tf.data.Dataset.map function
+    """ Decodes an tensor of type string to an uint8 tensor. Has to be applied with tf.data.Dataset.map function
         Args:
         img: image as tensor of type string
         Returns:
-        image as tensor of type float32
+        image as tensor of type uint8
     """
-    # convert the compressed string to a 3D uint8 tensor
+    # convert the compressed string to a 3D uint8 tensor, conversion to float32 is deferred to to_float
     img = tf.image.decode_png(img, channels=3)
-    # Use `convert_image_dtype` to convert to floats in the [0,1] range.
-    img = tf.image.convert_image_dtype(img, tf.float32)
     return img
 
 
+def to_float(image, mask, image_path):
+    """ Converts uint8 images and masks to float32 in the [0,1] range. Has to be applied with tf.data.Dataset.map
+        function
+        Args:
+        image: image as [heigth, width, channels] or [batchsize, heigth, width, channels]
+        mask: mask as [heigth, width, channels] or [batchsize, heigth, width, channels]
+        image_path: Path of image files. used to map images afterwards
+        Returns:
+        image, mask, image_path
+    """
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    mask = tf.image.convert_image_dtype(mask, tf.float32)
+    return image, mask, image_path
+
+
 def process_path(image_path, mask_path):
     """ Reads images and masks based on their file paths. Has to be applied with tf.data.Dataset.map function
         Args:
@@ -103,51 +118,88 @@ def process_path(image_path, mask_path):
     return img, msk, image_path
 
 
-def random_flip(image, mask, image_path):
-    """ Random flip images and masks. Has to be applied with tf.data.Dataset.map function
+def create_seed_set():
+    """ Creates an infinite tf.data Dataset of seeds for the stateless random augmentations. The seeds are drawn by a
+        stateful op, so every iteration over the dataset (every epoch) yields new seeds.
+        Returns:
+        dataset of seeds as [2] int64 tensors
+    """
+    return tf.data.experimental.Counter().map(
+        lambda _: tf.random.uniform([2], maxval=np.iinfo(np.int64).max, dtype=tf.int64))
+
+
+def split_seed(seed, num=2):
+    """ Derives new independent seeds from a seed for stateless random ops.
         Args:
-        image: image as [heigth, width, channels]
-        mask: mask as [heigth, width, channels]
+        seed: seed as [2] int tensor
+        num: number of seeds to derive
+        Returns:
+        seeds as [num, 2] int64 tensor
+    """
+    return tf.random.stateless_uniform([num, 2], seed=seed, minval=0, maxval=np.iinfo(np.int64).max,
+                                       dtype=tf.int64)
+
+
+def random_flip(image, mask, image_path, seed):
+    """ Random flip batched images and masks, decided per sample. Has to be applied with tf.data.Dataset.map function
+        after batching
+        Args:
+        image: images as [batchsize, heigth, width, channels]
+        mask: masks as [batchsize, heigth, width, channels]
         image_path: Path of image files. used to map images afterwards
+        seed: seed for the stateless random ops as [2] int tensor
         Returns:
         image, mask, image_path
     """
-    if tf.random.uniform(()) > 0.5:
-        image = tf.image.flip_left_right(image)
-        mask = tf.image.flip_left_right(mask)
+    batch_size = tf.shape(image)[0]
+    seeds = split_seed(seed, 2)
 
-    if tf.random.uniform(()) > 0.5:
-        image = tf.image.flip_up_down(image)
-        mask = tf.image.flip_up_down(mask)
+    flip = tf.random.stateless_uniform([batch_size, 1, 1, 1], seed=seeds[0]) > 0.5
+    image = tf.where(flip, tf.reverse(image, axis=[2]), image)
+    mask = tf.where(flip, tf.reverse(mask, axis=[2]), mask)
+
+    flip = tf.random.stateless_uniform([batch_size, 1, 1, 1], seed=seeds[1]) > 0.5
+    image = tf.where(flip, tf.reverse(image, axis=[1]), image)
+    mask = tf.where(flip, tf.reverse(mask, axis=[1]), mask)
 
     return image, mask, image_path
 
 
-def random_crop(image, mask, image_path):
+def random_crop(image, mask, image_path, seed):
     """ Random crops images and masks. Has to be applied with tf.data.Dataset.map function
         Args:
         image: image as [heigth, width, channels]
         mask: mask as [heigth, width, channels]
         image_path: Path of image files. used to map images afterwards
+        seed: seed for the stateless random ops as [2] int tensor
         Returns:
         image, mask, image_path
     """
-    stacked_image = tf.stack([image, mask], axis=0)
-    cropped_image = tf.image.random_crop(stacked_image, size=[2, IMG_HEIGHT, IMG_WIDTH, 3])
-    return cropped_image[0], cropped_image[1], image_path
+    # one shared offset for image and mask, avoids stacking both into a temporary tensor
+    shape = tf.shape(image)
+    seeds = split_seed(seed, 2)
+    offset_h = tf.random.stateless_uniform([], seeds[0], 0, shape[0] - IMG_HEIGHT + 1, dtype=tf.int32)
+    offset_w = tf.random.stateless_uniform([], seeds[1], 0, shape[1] - IMG_WIDTH + 1, dtype=tf.int32)
+    image = tf.ensure_shape(image[offset_h:offset_h + IMG_HEIGHT, offset_w:offset_w + IMG_WIDTH],
+                            [IMG_HEIGHT, IMG_WIDTH, 3])
+    mask = tf.ensure_shape(mask[offset_h:offset_h + IMG_HEIGHT, offset_w:offset_w + IMG_WIDTH],
+                           [IMG_HEIGHT, IMG_WIDTH, 3])
+    return image, mask, image_path
 
 
-def random_brightness(image, mask, image_path):
-    """ Adds random brightness to images. Has to be applied with tf.data.Dataset.map function
+def random_brightness(image, mask, image_path, seed):
+    """ Adds random brightness to batched images, one delta per sample. Has to be applied with tf.data.Dataset.map
+        function after batching
         Args:
-        image: image as [heigth, width, channels]
-        mask: mask as [heigth, width, channels]
+        image: images as [batchsize, heigth, width, channels]
+        mask: masks as [batchsize, heigth, width, channels]
         image_path: Path of image files. used to map images afterwards
+        seed: seed for the stateless random ops as [2] int tensor
         Returns:
         image, mask, image_path
     """
-    image = tf.image.random_brightness(image, 0.2)
-    image = tf.clip_by_value(image, 0.0, 1.0)
+    delta = tf.random.stateless_uniform([tf.shape(image)[0], 1, 1, 1], seed, -0.2, 0.2)
+    image = tf.clip_by_value(image + delta, 0.0, 1.0)
     return image, mask, image_path
 
 
@@ -161,33 +213,190 @@ def central_crop(image, mask, image_path):
         Returns:
         image, mask, image_path
     """
-    image = image[64:-64, 64:-64]
-    mask = mask[64:-64, 64:-64]
+    # static begin and size, source images are IMG_HEIGHT + 128 by IMG_WIDTH + 128
+    image = tf.slice(image, [64, 64, 0], [IMG_HEIGHT, IMG_WIDTH, -1])
+    mask = tf.slice(mask, [64, 64, 0], [IMG_HEIGHT, IMG_WIDTH, -1])
     return image, mask, image_path
 
 
-def add_gaussian_noise(image, mask, image_path):
-    """ Adds gaussion noise to images. Has to be applied with tf.data.Dataset.map function
+def add_gaussian_noise(image, mask, image_path, seed):
+    """ Adds gaussion noise to half of the batched images. Has to be applied with tf.data.Dataset.map function after
+        batching
         Args:
-        image: image as [heigth, width, channels]
-        mask: mask as [heigth, width, channels]
+        image: images as [batchsize, heigth, width, channels]
+        mask: masks as [batchsize, heigth, width, channels]
         image_path: Path of image files. used to map images afterwards
+        seed: seed for the stateless random ops as [2] int tensor
         Returns:
         image, mask, image_path
     """
-    if tf.random.uniform(()) > 0.5:
-        noise = tf.random.normal(shape=tf.shape(image), mean=0.0, stddev=(10) / (255), dtype=tf.float32)
-        noise_img = image + noise
-        noise_img = tf.clip_by_value(noise_img, 0.0, 1.0)
-    else:
-        noise_img = image
+    seeds = split_seed(seed, 2)
+    apply_noise = tf.cast(tf.random.stateless_uniform([tf.shape(image)[0], 1, 1, 1], seeds[0]) > 0.5, tf.float32)
+    noise = tf.random.stateless_normal(shape=tf.shape(image), seed=seeds[1], mean=0.0, stddev=(10) / (255),
+                                       dtype=tf.float32)
+    noise_img = tf.clip_by_value(image + apply_noise * noise, 0.0, 1.0)
     return noise_img, mask, image_path
 
 
+@tf.function
+def batch_augment(images, masks, image_paths, seed):
+    """ Applies the random augmentations to a whole batch in a single traced function. Has to be applied with
+        tf.data.Dataset.map function after batching
+        Args:
+        images: images as [batchsize, heigth, width, channels]
+        masks: masks as [batchsize, heigth, width, channels]
+        image_paths: Paths of image files. used to map images afterwards
+        seed: seed for the stateless random ops as [2] int tensor
+        Returns:
+        images, masks, image_paths
+    """
+    batch = to_float(images, masks, image_paths)
+    seeds = split_seed(seed, 3)
+    for i, func in enumerate([random_brightness, random_flip, add_gaussian_noise]):
+        batch = func(*batch, seeds[i])
+    return batch
+
+
 def unindex(image, mask, image_path):
     return image, mask
 
 
+def create_dataset_options(deterministic=True):
+    """ Creates tf.data Options which enable map fusion and map and batch fusion and run the pipeline in a private
+        threadpool with one thread per core, so the png decoding scales with the number of cores.
+        Args:
+        deterministic: if False, parallel map outputs may be returned out of order
+        Returns:
+        tf.data.Options
+    """
+    options = tf.data.Options()
+    options.experimental_deterministic = deterministic
+    options.experimental_threading.private_threadpool_size = os.cpu_count()
+    options.experimental_threading.max_intra_op_parallelism = 1
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    return options
+
+
+def load_image_set(set_list):
+    """ Creates a tf.data Dataset of decoded images and masks from png files.
+        Args:
+        set_list: tuple of file patterns (images, masks)
+        Returns:
+        dataset of uint8 image, mask, image_path
+    """
+    images = tf.data.Dataset.list_files(set_list[0], shuffle=False)
+    masks = tf.data.Dataset.list_files(set_list[1], shuffle=False)
+    data_set = tf.data.Dataset.zip((images, masks))
+
+    def read_pair(image_path, mask_path):
+        return tf.data.Dataset.from_tensors((image_path, mask_path)).map(process_path)
+
+    # interleave keeps several file reads in flight at once
+    return data_set.interleave(read_pair, cycle_length=PARALLEL_CALLS, num_parallel_calls=PARALLEL_CALLS)
+
+
+def write_tfrecords(set_list, output_prefix, num_shards=4):
+    """ Decodes images and masks once and writes them as raw uint8 bytes into sharded TFRecord files.
+        Args:
+        set_list: tuple of file patterns (images, masks)
+        output_prefix: prefix of the shard files, e.g. 'data/train'
+        num_shards: number of shard files
+        Returns:
+        list of shard file paths
+    """
+    shards = ['{}-{:05d}-of-{:05d}.tfrecord'.format(output_prefix, i, num_shards) for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(shard) for shard in shards]
+
+    images = tf.data.Dataset.list_files(set_list[0], shuffle=False)
+    masks = tf.data.Dataset.list_files(set_list[1], shuffle=False)
+    for i, (image_path, mask_path) in enumerate(tf.data.Dataset.zip((images, masks))):
+        img = tf.image.decode_png(tf.io.read_file(image_path), channels=3).numpy()
+        msk = tf.image.decode_png(tf.io.read_file(mask_path), channels=3).numpy()
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.tobytes()])),
+            'mask': tf.train.Feature(bytes_list=tf.train.BytesList(value=[msk.tobytes()])),
+            'height': tf.train.Feature(int64_list=tf.train.Int64List(value=[img.shape[0]])),
+            'width': tf.train.Feature(int64_list=tf.train.Int64List(value=[img.shape[1]])),
+            'image_path': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_path.numpy()]))}))
+        writers[i % num_shards].write(example.SerializeToString())
+
+    for writer in writers:
+        writer.close()
+    return shards
+
+
+def parse_example(serialized):
+    """ Parses an example written by write_tfrecords to uint8 tensors. Has to be applied with tf.data.Dataset.map
+        function
+        Args:
+        serialized: serialized tf.train.Example as tensor of type string
+        Returns:
+        image, mask, image_path
+    """
+    features = tf.io.parse_single_example(serialized, {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'mask': tf.io.FixedLenFeature([], tf.string),
+        'height': tf.io.FixedLenFeature([], tf.int64),
+        'width': tf.io.FixedLenFeature([], tf.int64),
+        'image_path': tf.io.FixedLenFeature([], tf.string)})
+    shape = tf.stack([features['height'], features['width'], 3])
+    img = tf.reshape(tf.io.decode_raw(features['image'], tf.uint8), shape)
+    msk = tf.reshape(tf.io.decode_raw(features['mask'], tf.uint8), shape)
+    return img, msk, features['image_path']
+
+
+def load_tfrecord_set(shards):
+    """ Creates a tf.data Dataset of decoded images and masks from TFRecord files.
+        Args:
+        shards: list of TFRecord files written by write_tfrecords
+        Returns:
+        dataset of uint8 image, mask, image_path
+    """
+    data_set = tf.data.TFRecordDataset(shards, num_parallel_reads=tf.data.experimental.AUTOTUNE)
+    return data_set.map(parse_example, num_parallel_calls=PARALLEL_CALLS)
+
+
+def prepare_train_set(data_set, buffer_size, batch_size):
+    """ Caches, shuffles, augments and batches a dataset of decoded images and masks for training.
+        Args:
+        data_set: dataset of uint8 image, mask, image_path
+        buffer_size: Shuffle buffer size
+        batch_size: Batch size
+        Returns:
+        train dataset
+    """
+    # cache the decoded uint8 images, shuffle and random augmentations still vary per epoch
+    data_set = data_set.cache()
+    data_set = data_set.shuffle(buffer_size)
+    # one base seed per sample and per batch, drawn anew in every epoch
+    data_set = tf.data.Dataset.zip((data_set, create_seed_set()))
+    data_set = data_set.map(lambda sample, seed: random_crop(*sample, seed), num_parallel_calls=PARALLEL_CALLS)
+    data_set = data_set.batch(batch_size, drop_remainder=False)
+    data_set = tf.data.Dataset.zip((data_set, create_seed_set()))
+    data_set = data_set.map(lambda batch, seed: batch_augment(*batch, seed), num_parallel_calls=PARALLEL_CALLS)
+    data_set = data_set.with_options(create_dataset_options(deterministic=False))
+    return data_set.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def prepare_eval_set(data_set, batch_size, crop=False):
+    """ Caches and batches a dataset of decoded images and masks for validation or testing.
+        Args:
+        data_set: dataset of uint8 image, mask, image_path
+        batch_size: Batch size
+        crop: if True, applies central_crop
+        Returns:
+        val or test dataset
+    """
+    if crop:
+        data_set = data_set.map(central_crop, num_parallel_calls=PARALLEL_CALLS)
+    data_set = data_set.cache()
+    data_set = data_set.batch(batch_size, drop_remainder=False)
+    data_set = data_set.map(to_float, num_parallel_calls=PARALLEL_CALLS)
+    data_set = data_set.with_options(create_dataset_options(deterministic=True))
+    return data_set.prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def create_train_datasets(train_set_list, val_set_list, test_set_list, buffer_size, batch_size):
     """ Creates a tf.data Dataset.
         Args:
@@ -199,29 +408,27 @@ def create_train_datasets(train_set_list, val_set_list, test_set_list, buffer_si
         Returns:
         train dataset, val_dataset, test dataset
     """
-    train_set_images = tf.data.Dataset.list_files(train_set_list[0], shuffle=False)
-    train_set_masks = tf.data.Dataset.list_files(train_set_list[1], shuffle=False)
-    train_set = tf.data.Dataset.zip((train_set_images, train_set_masks))
-    train_set = train_set.shuffle(buffer_size)
-
-    for func in [process_path, random_crop, random_brightness, random_flip, add_gaussian_noise]:
-        train_set = train_set.map(func, num_parallel_calls=PARALLEL_CALLS)
-    train_set = train_set.batch(batch_size, drop_remainder=False)
-
-    val_set_images = tf.data.Dataset.list_files(val_set_list[0], shuffle=False)
-    val_set_masks = tf.data.Dataset.list_files(val_set_list[1], shuffle=False)
-    val_set = tf.data.Dataset.zip((val_set_images, val_set_masks))
+    train_set = prepare_train_set(load_image_set(train_set_list), buffer_size, batch_size)
+    val_set = prepare_eval_set(load_image_set(val_set_list), batch_size, crop=True)
+    test_set = prepare_eval_set(load_image_set(test_set_list), batch_size)
 
-    for func in [process_path, central_crop]:
-        val_set = val_set.map(func, num_parallel_calls=PARALLEL_CALLS)
-    val_set = val_set.batch(batch_size, drop_remainder=False)
+    return train_set, val_set, test_set
 
-    test_set_images = tf.data.Dataset.list_files(test_set_list[0], shuffle=False)
-    test_set_masks = tf.data.Dataset.list_files(test_set_list[1], shuffle=False)
-    test_set = tf.data.Dataset.zip((test_set_images, test_set_masks))
 
-    test_set = test_set.map(process_path, num_parallel_calls=PARALLEL_CALLS)
-    test_set = test_set.batch(batch_size, drop_remainder=False)
+def create_tfrecord_datasets(train_shards, val_shards, test_shards, buffer_size, batch_size):
+    """ Creates a tf.data Dataset from TFRecord files written by write_tfrecords.
+        Args:
+        train_shards: list of train TFRecord files
+        val_shards: list of val TFRecord files
+        test_shards: list of test TFRecord files
+        buffer_size: Shuffle buffer size
+        batch_size: Batch size
+        Returns:
+        train dataset, val_dataset, test dataset
+    """
+    train_set = prepare_train_set(load_tfrecord_set(train_shards), buffer_size, batch_size)
+    val_set = prepare_eval_set(load_tfrecord_set(val_shards), batch_size, crop=True)
+    test_set = prepare_eval_set(load_tfrecord_set(test_shards), batch_size)
 
     return train_set, val_set, test_set
 
@@ -260,6 +467,19 @@ def simple_upblock(input_layer, filters, size, block_name, norm_type='batchnorm'
     return x
 
 
+def enable_mixed_precision(policy_name='mixed_float16'):
+    """ Sets the global keras mixed precision policy. Has to be called before the model is created. Layers then compute
+        in float16 (or bfloat16) while keeping float32 weights. Requires tensorflow >= 2.4, where model.compile also
+        adds the loss scaling; the pinned tensorflow 2.0 raises a RuntimeError.
+        Args:
+        policy_name: either: 'mixed_float16' (GPU) or 'mixed_bfloat16' (TPU)
+    """
+    version = tuple(int(v) for v in tf.__version__.split('.')[:2])
+    if version < (2, 4):
+        raise RuntimeError('Mixed precision requires tensorflow >= 2.4, found {}'.format(tf.__version__))
+    tf.keras.mixed_precision.set_global_policy(policy_name)
+
+
 def create_backbone(name='vgg19', set_trainable=True):
     """ Creates a backbone for segmentation model.
         Args:
@@ -295,11 +515,8 @@ def segmentation_model_func(output_channels, backbone_name, backbone_trainable=T
     """
     down_stack = create_backbone(name=backbone_name, set_trainable=backbone_trainable)
 
-    skips = [down_stack.get_layer(BACKBONE_LAYER_NAMES[backbone_name][0]).output,
-             down_stack.get_layer(BACKBONE_LAYER_NAMES[backbone_name][1]).output,
-             down_stack.get_layer(BACKBONE_LAYER_NAMES[backbone_name][2]).output,
-             down_stack.get_layer(BACKBONE_LAYER_NAMES[backbone_name][3]).output,
-             down_stack.get_layer(BACKBONE_LAYER_NAMES[backbone_name][4]).output]
+    name_to_layer = {layer.name: layer for layer in down_stack.layers}
+    skips = [name_to_layer[name].output for name in BACKBONE_LAYER_NAMES[backbone_name]]
 
     up_stack_filters = [64, 128, 256, 512]
 
@@ -315,7 +532,9 @@ def segmentation_model_func(output_channels, backbone_name, backbone_trainable=T
     # x = simple_upblock_func(x, 32, 3, 'up_stack' + str(32))
     x = tf.keras.layers.UpSampling2D(2)(x)
     x = tf.keras.layers.Conv2D(32, 3, activation='relu', padding='same')(x)
-    x = tf.keras.layers.Conv2D(output_channels, 1, activation='softmax', padding='same', name='final_output')(x)
+    # keep the softmax output in float32 for numerically stable losses under mixed precision
+    x = tf.keras.layers.Conv2D(output_channels, 1, activation='softmax', padding='same', dtype='float32',
+                               name='final_output')(x)
 
     return tf.keras.Model(inputs=down_stack.layers[0].input, outputs=x)
 
@@ -344,8 +563,7 @@ def show(dataset, model=None, rows=1, threshold=0.5):
             image, mask = batch[0][0], batch[1][0]
             tmp_mask = mask.numpy().copy()
             tmp_mask[:, :, 2] = 0
-            overlay = cv2.add(image.numpy().astype(float), np.multiply(tmp_mask, 0.5).astype(float))
-            overlay = np.clip(overlay, 0, 1)
+            overlay = np.clip(image.numpy() + 0.5 * tmp_mask, 0.0, 1.0)
             display(image, mask, overlay)
         else:
             prediction = model.predict(batch[0]) > threshold
@@ -360,47 +578,42 @@ def get_dice_score(msk, pred, skip_background=True):
         pred: prediction mask [batchsize, height, width, classes], type bool
         skip_background: if skipping last class (background) for calculation
         Returns:
-        dice scalar
+        dice scalar as tensor
     """
+    msk = tf.cast(msk, tf.float32)
+    pred = tf.cast(pred, tf.float32)
+
     if skip_background:
         msk = msk[..., 0:2]
         pred = pred[..., 0:2]
 
-    batch_size = msk.shape[0]
-    metric = []
+    intersection = tf.reduce_sum(msk * pred, axis=[1, 2, 3])
+    denominator = tf.reduce_sum(msk, axis=[1, 2, 3]) + tf.reduce_sum(pred, axis=[1, 2, 3])
+    dice_score = 2. * intersection / tf.maximum(denominator, np.finfo(np.float32).eps)
 
-    for batch in range(batch_size):
-        m, p = msk[batch], pred[batch]
-        intersection = np.logical_and(m, p)
-        denominator = np.sum(m) + np.sum(p)
-        if denominator == 0.0:
-            denominator = np.finfo(float).eps
-        dice_score = 2. * np.sum(intersection) / denominator
-        metric.append(dice_score)
-
-    return np.mean(metric)
+    return tf.reduce_mean(dice_score)
 
 
 def my_dice_metric_hemp(label, pred):
-    """ Converts dice score metric to tensorflow graph, only hemp
+    """ Dice score metric as tensorflow graph, only hemp
         Args:
         label: ground truth mask [batchsize, height, width, classes]
         pred: prediction mask [batchsize, height, width, classes]
         Returns:
         dice value as tensor
     """
-    return tf.py_function(get_dice_score, [label > 0.5, pred > 0.5], tf.float32)
+    return get_dice_score(label > 0.5, pred > 0.5)
 
 
 def my_dice_metric_all(label, pred):
-    """ Converts dice score metric to tensorflow graph, all classes
+    """ Dice score metric as tensorflow graph, all classes
         Args:
         label: ground truth mask [batchsize, height, width, classes]
         pred: prediction mask [batchsize, height, width, classes]
         Returns:
         dice value as tensor
     """
-    return tf.py_function(get_dice_score, [label > 0.5, pred > 0.5, False], tf.float32)
+    return get_dice_score(label > 0.5, pred > 0.5, skip_background=False)
 
 
 def gather_channels(*xs, indexes=None, **kwargs):
@@ -461,8 +674,17 @@ def categorical_focal_loss(gt, pr, gamma=2.0, alpha=0.25, class_indexes=None, ba
     # clip to prevent NaN's and Inf's
     pr = backend.clip(pr, backend.epsilon(), 1.0 - backend.epsilon())
 
+    # integer gamma (default 2.0) as repeated multiplication instead of exp/log based pow
+    one_minus_pr = 1 - pr
+    if isinstance(gamma, (int, float)) and float(gamma).is_integer() and gamma >= 1:
+        modulating_factor = one_minus_pr
+        for _ in range(int(gamma) - 1):
+            modulating_factor = modulating_factor * one_minus_pr
+    else:
+        modulating_factor = backend.pow(one_minus_pr, gamma)
+
     # Calculate focal loss
-    loss = - gt * (alpha * backend.pow((1 - pr), gamma) * backend.log(pr))
+    loss = - gt * (alpha * modulating_factor * backend.log(pr))
 
     return backend.mean(loss)
 
@@ -508,7 +730,7 @@ def dice_loss(gt, pr):
         Returns:
         dice loss as tensor
     """
-    return 1 - f_score(gt, pr, class_weights=np.array([0.5, 0.5, 1.]), smooth=1.0)
+    return 1 - f_score(gt, pr, class_weights=DICE_CLASS_WEIGHTS, smooth=1.0)
 
 
 def cce_loss(gt, pr):
@@ -519,7 +741,7 @@ def cce_loss(gt, pr):
         Returns:
         categorical crossentropy loss as tensor
     """
-    return tf.keras.losses.categorical_crossentropy(gt, pr, label_smoothing=0.3)
+    return CCE(gt, pr)
 
 
 def dice_cce(gt, pr, dice_weight=1., cce_weight=1.):
@@ -535,30 +757,19 @@ def dice_cce(gt, pr, dice_weight=1., cce_weight=1.):
     return dice_weight * dice_loss(gt, pr) + cce_weight * cce_loss(gt, pr)
 
 
-class StepDecay():
-    """ Creates a learning rate Step Decay callback for training
+def step_decay(steps_per_epoch, init_alpha=0.01, factor=0.25, drop_every=10):
+    """ Creates a learning rate Step Decay schedule which is evaluated inside the optimizer
         Args:
-        initAlpha: initial learning rate
+        steps_per_epoch: Training steps per epoch, converts drop_every from epochs to optimizer steps
+        init_alpha: initial learning rate
         factor: factor by which to multiply the learning rate after every drop
-        dropEvery: Epochs to drop the learning rate
+        drop_every: Epochs to drop the learning rate
         Returns:
-        Learning rate based on settings and current epoch
+        tf.keras learning rate schedule, to be passed as learning_rate to the optimizer
     """
-    def __init__(self, initAlpha=0.01, factor=0.25, dropEvery=10):
-        # store the base initial learning rate, drop factor, and
-        # epochs to drop every
-        self.initAlpha = initAlpha
-        self.factor = factor
-        self.dropEvery = dropEvery
-
-    def __call__(self, epoch):
-        # compute the learning rate for the current epoch
-        exp = np.floor((1 + epoch) / self.dropEvery)
-        alpha = self.initAlpha * (self.factor ** exp)
-
-        # return the learning rate
-        print(" Learning Rate: " + str(float(alpha)))
-        return float(alpha)
+    return tf.keras.optimizers.schedules.ExponentialDecay(initial_learning_rate=init_alpha,
+                                                          decay_steps=steps_per_epoch * drop_every,
+                                                          decay_rate=factor, staircase=True)
 
 
 def visualize_layers(input_img, input_msk, model, outputs, shift=0):
@@ -572,30 +783,25 @@ def visualize_layers(input_img, input_msk, model, outputs, shift=0):
     fig, ax = plt.subplots(len(outputs), 4, figsize=(15, 15))
 
     input_msk[:, :, 2] = 0
-    out_img = cv2.add(input_img.astype(float), np.multiply(input_msk, 0.3).astype(float))
-    out_img = np.clip(out_img, 0, 1)
+    out_img = np.clip(input_img + 0.3 * input_msk, 0.0, 1.0)
 
     for j, output in enumerate(outputs):
         submodel = tf.keras.models.Model([model.inputs[0]], [model.get_layer(output).output])
         pred = submodel.predict(input_img.reshape(1, 384, 384, 3))
         plt.yticks()
-        channels = []
-        stds = []
-        for channel in range(pred.shape[-1]):
-            layer = pred.squeeze()[:, :, channel]
-            stds.append(np.std(layer))
-            channels.append(layer)
-
-        if shift == 0:
-            stds = sorted(range(len(stds)), key=lambda x: stds[x])[-4:]
-        else:
-            stds = sorted(range(len(stds)), key=lambda x: stds[x])[-4 - shift:-shift]
+        layers = pred.squeeze()
+        stds = layers.std(axis=(0, 1))
+
+        # 4 channels with the highest std after skipping the top `shift`, in ascending order,
+        # layers with fewer channels return all of them
+        k = min(4 + shift, stds.size)
+        top = np.argpartition(-stds, k - 1)[:k]
+        top = top[np.argsort(stds[top])][:max(k - shift, 0)]
 
-        channels = [channels[i] for i in stds]
-        channels = np.stack(channels, 0)
+        channels = layers[..., top].transpose(2, 0, 1)
 
         for c in range(3):
-            ax[j, c].imshow(skimage.filters.gaussian(channels[c], sigma=0.1), cmap='jet', aspect='auto')
+            ax[j, c].imshow(channels[c], cmap='jet', aspect='auto')
         ax[j, 3].imshow(out_img, aspect='auto')
         ax[j, 0].set(ylabel="Stage {}".format(j + 1))
 